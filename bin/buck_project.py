@@ -34,6 +34,9 @@ class BuckProject:
         if not os.path.exists(self._buck_out_log):
             os.makedirs(self._buck_out_log)
         self.tmp_dir = tempfile.mkdtemp(prefix="buck_run.", dir=buck_out_tmp)
+        # Kept outside .buckd, which is removed whenever buckd is killed.
+        self.buck_version_uid_cache_file = os.path.join(
+            self._buck_out, "uid-cache.json")
 
         # Only created if buckd is used.
         self.buckd_tmp_dir = None
@@ -68,6 +71,16 @@ class BuckProject:
     def get_running_buckd_version(self):
         return get_file_contents_if_exists(self.buckd_version_file)
 
+    def get_buck_version_uid_cache(self):
+        contents = get_file_contents_if_exists(
+            self.buck_version_uid_cache_file)
+        if not contents:
+            return None
+        try:
+            return json.loads(contents)
+        except ValueError:
+            return None
+
     def get_buckd_pid(self):
         return get_file_contents_if_exists(self.buckd_pid_file)
 
@@ -91,9 +104,10 @@ class BuckProject:
                 ['watchman', 'trigger-list', self.root])
             trigger_list = json.loads(trigger_list_output)
             if not trigger_list.get('triggers'):
-                subprocess.call(
-                    ['watchman', 'watch-del', self.root],
-                    stdout=open(os.devnull, 'w'))
+                with open(os.devnull, 'w') as dev_null:
+                    subprocess.call(
+                        ['watchman', 'watch-del', self.root],
+                        stdout=dev_null)
 
     def create_buckd_tmp_dir(self):
         tmp_dir_parent = os.path.join(self.buckd_dir, "tmp")
@@ -111,6 +125,10 @@ class BuckProject:
     def save_buckd_version(self, version):
         write_contents_to_file(self.buckd_version_file, version)
 
+    def save_buck_version_uid_cache(self, cache):
+        write_contents_to_file(
+            self.buck_version_uid_cache_file, json.dumps(cache))
+
     @staticmethod
     def from_current_dir():
         current_dir = os.getcwd()
@@ -125,10 +143,13 @@ class BuckProject:
     def __enter__(self):
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def clean_up_tmp_dir(self):
         if os.path.exists(self.tmp_dir):
             shutil.rmtree(self.tmp_dir)
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.clean_up_tmp_dir()
+
 
 class NoBuckConfigFoundException(Exception):
 
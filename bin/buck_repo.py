@@ -1,16 +1,24 @@
 from __future__ import print_function
 import errno
+import hashlib
 import os
-import pty
 import re
-import socket
+import select
+import shlex
 import signal
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 
+# pty, tty and socket (and through them termios and _ssl) are only needed to
+# start or probe buckd, so they are imported by the methods that use them
+# rather than on every buck command.
+
 JAVA_CLASSPATHS = [
     "src",
     "build/abi_processor/classes",
@@ -65,6 +73,7 @@ JAVA_CLASSPATHS = [
     "third-party/java/xz-java-1.3/xz-1.3.jar",
     "third-party/java/commons-compress/commons-compress-1.8.1.jar",
 ]
+JAVA_CLASSPATHS_PARTS = [p.split('/') for p in JAVA_CLASSPATHS]
 
 BUCK_DIR_JAVA_ARGS = {
     "testrunner_classes": "build/testrunner/classes",
@@ -89,13 +98,22 @@ BUCK_DIR_JAVA_ARGS = {
     "dx": "third-party/java/dx-from-kitkat/etc/dx",
     "android_agent_path": "assets/android/agent.apk"
 }
+BUCK_DIR_JAVA_ARGS_PARTS = dict(
+    (key, tuple(value.split('/'))) for key, value in BUCK_DIR_JAVA_ARGS.items())
 
 MAX_BUCKD_RUN_COUNT = 64
 BUCKD_CLIENT_TIMEOUT_MILLIS = 60000
 GC_MAX_PAUSE_TARGET = 15000
+BUCKD_STARTUP_TIMEOUT_SECS = 10
+BUCKD_OUTPUT_READ_SIZE = 4096
+BUCKD_SHUTDOWN_TIMEOUT_SECS = 10
+SHM_DIR = '/dev/shm'
+
+# State of a listening socket in /proc/net/tcp.
+TCP_LISTEN_STATE = '0A'
 
 BUCKD_LOG_FILE_PATTERN = re.compile('^NGServer.* port (\d+)\.$')
-DEV_NULL = open(os.devnull, 'w')
+JAVA_RELEASE_VERSION_PATTERN = re.compile('^JAVA_VERSION="1\.8\.', re.MULTILINE)
 
 
 class BuckRepo:
@@ -107,13 +125,38 @@ class BuckRepo:
             self._buck_dir, "build", "successful-build")
         self._buck_client_file = os.path.join(
             self._buck_dir, "build", "ng")
+        self._java_classpath = os.pathsep.join(
+            os.path.join(self._buck_dir, *parts)
+            for parts in JAVA_CLASSPATHS_PARTS)
+        self._joined_buck_dir_args = dict(
+            (key, os.path.join(self._buck_dir, *parts))
+            for key, parts in BUCK_DIR_JAVA_ARGS_PARTS.items())
+        self._static_buck_dir_args = tuple(
+            ["-Dbuck.buck_dir={0}".format(self._buck_dir),
+             "-Dlog4j.configuration=file:{0}".format(
+                 os.path.join(self._buck_dir, "config", "log4j.properties"))] +
+            ["-Dbuck.{0}={1}".format(key, path)
+             for key, path in self._joined_buck_dir_args.items()])
 
         self._buck_project = buck_project
         self._tmp_dir = buck_project.tmp_dir
 
-        dot_git = os.path.join(self._buck_dir, '.git')
-        self._is_git = os.path.exists(dot_git) and os.path.isdir(dot_git)
+        dot_git_stat = _stat_or_none(os.path.join(self._buck_dir, '.git'))
+        self._is_git = (dot_git_stat is not None and
+                        stat.S_ISDIR(dot_git_stat.st_mode))
         self._is_buck_repo_dirty_override = os.environ.get('BUCK_REPOSITORY_DIRTY')
+        # Absolute path of git, resolved once so that every git child is
+        # started from a full path instead of searching PATH again.
+        self._git_path = (which('git') if self._is_git else None) or 'git'
+
+        # Results of git queries, filled in lazily so that each git command
+        # is run at most once per invocation.
+        self._cached_revision = None
+        self._cached_timestamp = None
+        self._cached_status = None
+        self._cached_has_ant = None
+        self._cached_has_watchman = None
+        self._built = False
 
         buck_version = buck_project.buck_version
         if self._is_git and not buck_project.has_no_buck_check and buck_version:
@@ -121,6 +164,8 @@ class BuckRepo:
             branch = buck_version[1] if len(buck_version) > 1 else None
             self._checkout_and_clean(revision, branch)
 
+        if self._is_git:
+            self._prefetch_git_state()
         self._buck_version_uid = self._get_buck_version_uid()
 
     def launch_buck(self):
@@ -130,7 +175,8 @@ class BuckRepo:
         self._build()
 
         use_buckd = not os.environ.get('NO_BUCKD')
-        has_watchman = bool(which('watchman'))
+        has_watchman = self._has_watchman()
+        buckd_running = False
         if use_buckd and has_watchman:
             buckd_run_count = self._buck_project.get_buckd_run_count()
             running_version = self._buck_project.get_running_buckd_version()
@@ -141,15 +187,18 @@ class BuckRepo:
                 self.kill_buckd()
                 new_buckd_run_count = 0
 
-            if new_buckd_run_count == 0 or not self._is_buckd_running():
-                self.launch_buckd()
-            else:
+            if new_buckd_run_count != 0:
+                buckd_running = self._is_buckd_running()
+            if buckd_running:
                 self._buck_project.update_buckd_run_count(new_buckd_run_count)
+            else:
+                self.launch_buckd()
+                buckd_running = self._is_buckd_running()
         elif use_buckd and not has_watchman:
             print("Not using buckd because watchman isn't installed.",
                   file=sys.stderr)
 
-        if self._is_buckd_running() and os.path.exists(self._buck_client_file):
+        if buckd_running and os.path.exists(self._buck_client_file):
             print("Using buckd.", file=sys.stderr)
             buckd_port = self._buck_project.get_buckd_port()
             if not buckd_port or not buckd_port.isdigit():
@@ -163,18 +212,22 @@ class BuckRepo:
                 command.append(buckd_port)
                 command.append("com.facebook.buck.cli.Main")
                 command.extend(sys.argv[1:])
-                exit_code = subprocess.call(command, cwd=self._buck_project.root)
-                if exit_code == 2:
-                    print('Daemon is busy, please wait',
-                          'or run "buckd --kill" to terminate it.',
-                          file=sys.stderr)
-                return exit_code
+
+                # Nothing is left to do once the client exits, so replace this
+                # process with it instead of keeping python around to wait.
+                # The per-run tmp dir is only used when buck runs without the
+                # daemon, and the usual clean up will not happen after exec.
+                self._buck_project.clean_up_tmp_dir()
+                os.chdir(self._buck_project.root)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.execv(self._buck_client_file, command)
 
         command = ["java"]
         command.extend(self._get_java_args(self._buck_version_uid))
         command.append("-Djava.io.tmpdir={0}".format(self._tmp_dir))
         command.append("-classpath")
-        command.append(self._get_java_classpath())
+        command.append(self._java_classpath)
         command.append("com.facebook.buck.cli.Main")
         command.extend(sys.argv[1:])
         return subprocess.call(command, cwd=self._buck_project.root)
@@ -201,7 +254,7 @@ class BuckRepo:
         command.append("-XX:SoftRefLRUPolicyMSPerMB=0")
         command.append("-Djava.io.tmpdir={0}".format(buckd_tmp_dir))
         command.append("-classpath")
-        command.append(self._get_java_classpath())
+        command.append(self._java_classpath)
         command.append("com.martiansoftware.nailgun.NGServer")
         command.append("localhost:0")
         command.append("{0}".format(BUCKD_CLIENT_TIMEOUT_MILLIS))
@@ -213,7 +266,13 @@ class BuckRepo:
         file, the super console no longer works on subsequent invocations of
         buck. So use a pseudo-terminal to interact with it.
         '''
+        import pty
+        import tty
         master, slave = pty.openpty()
+        # buckd only needs its stdout to be a terminal, and nothing but the
+        # port scan below reads it, so switch off the line discipline's echo,
+        # line editing and output translation.
+        tty.setraw(slave)
 
         '''
         Change the process group of the child buckd process so that when this
@@ -228,19 +287,19 @@ class BuckRepo:
             stdout=slave,
             stderr=slave,
             preexec_fn=preexec_func)
+        # Only the child needs the slave end. Closing ours means reads from
+        # the master fail straight away if buckd dies during startup.
+        os.close(slave)
         self._buck_project.save_buckd_pid(process.pid)
-        stdout = os.fdopen(master)
 
-        for i in range(100):
-            line = stdout.readline().strip()
-            match = BUCKD_LOG_FILE_PATTERN.match(line)
-            if match:
-                buckd_port = match.group(1)
-                break
-            time.sleep(0.1)
-        else:
+        try:
+            buckd_port = read_buckd_port(master, BUCKD_STARTUP_TIMEOUT_SECS)
+        finally:
+            os.close(master)
+        if buckd_port is None:
             print(
-                "nailgun server did not respond after 10s. Aborting buckd.",
+                "nailgun server did not respond after {0}s. Aborting buckd."
+                .format(BUCKD_STARTUP_TIMEOUT_SECS),
                 file=sys.stderr)
             return
 
@@ -273,21 +332,25 @@ class BuckRepo:
             os.kill(buckd_pid, signal.SIGTERM)
             print("Waiting for existing buckd process to exit...",
                   file=sys.stderr)
-            for count in range(100):
-                time.sleep(0.1)
-                os.kill(buckd_pid, signal.SIGTERM)
-            else:
-                print(textwrap.dedent("""\
-                    Could not kill existing buckd process after 10 seconds!
-                    Force killing existing buckd process."""),
-                      file=sys.stderr)
-                os.kill(buckd_pid, signal.SIGKILL)
+            # Probing with signal 0 raises ESRCH once the process is gone.
+            deadline = time.time() + BUCKD_SHUTDOWN_TIMEOUT_SECS
+            delay = 0.01
+            while time.time() < deadline:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                os.kill(buckd_pid, 0)
+            print(textwrap.dedent("""\
+                Could not kill existing buckd process after {0} seconds!
+                Force killing existing buckd process.""".format(
+                BUCKD_SHUTDOWN_TIMEOUT_SECS)),
+                  file=sys.stderr)
+            os.kill(buckd_pid, signal.SIGKILL)
         except OSError as e:
             if e.errno != errno.ESRCH:
                 raise
 
     def _setup_watchman_watch(self):
-        if not which('watchman'):
+        if not self._has_watchman():
             message = textwrap.dedent("""\
                 Watchman not found, please install when using buckd.
                 See https://github.com/facebook/watchman for details.""")
@@ -298,10 +361,11 @@ class BuckRepo:
             raise BuckRepoException(message)
 
         print("Using watchman.", file=sys.stderr)
-        subprocess.check_call(
-            ['watchman', 'watch', self._buck_project.root],
-            stdout=DEV_NULL,
-            stderr=DEV_NULL)
+        with open(os.devnull, 'w') as dev_null:
+            subprocess.check_call(
+                ['watchman', 'watch', self._buck_project.root],
+                stdout=dev_null,
+                stderr=dev_null)
 
     def _is_buckd_running(self):
         buckd_pid = self._buck_project.get_buckd_pid()
@@ -316,7 +380,16 @@ class BuckRepo:
         except OSError:
             return False
 
+        listening = is_port_listening(int(buckd_port))
+        if listening is not None:
+            return listening
+
+        import socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Reset the connection on close rather than going through the
+        # FIN/ACK exchange; nothing is ever sent on it.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
         try:
             result = sock.connect_ex(('127.0.0.1', int(buckd_port)))
         finally:
@@ -326,13 +399,13 @@ class BuckRepo:
 
     def _checkout_and_clean(self, revision, branch):
         if not self._revision_exists(revision):
-            git_command = ['git', 'fetch']
+            git_command = ['fetch']
             git_command.extend(['--all'] if not branch else ['origin', branch])
             try:
-                subprocess.check_call(
+                self._run_git(
+                    subprocess.check_call,
                     git_command,
-                    stdout=sys.stderr,
-                    cwd=self._buck_dir)
+                    stdout=sys.stderr)
             except subprocess.CalledProcessError:
                 raise BuckRepoException(textwrap.dedent("""\
                       Failed to fetch Buck updates from git.
@@ -351,10 +424,13 @@ class BuckRepo:
                 current_revision, revision)),
                 file=sys.stderr)
 
-            subprocess.check_call(
-                ['git', 'checkout', revision],
-                stdout=sys.stderr,
-                cwd=self._buck_dir)
+            self._run_git(
+                subprocess.check_call,
+                ['checkout', revision],
+                stdout=sys.stderr)
+            self._cached_revision = None
+            self._cached_timestamp = None
+            self._cached_status = None
             if os.path.exists(self._build_success_file):
                 os.remove(self._build_success_file)
 
@@ -362,8 +438,46 @@ class BuckRepo:
             self._run_ant_clean()
             self._restart_buck()
 
-    def _join_buck_dir(self, relative_path):
-        return os.path.join(self._buck_dir, *(relative_path.split('/')))
+    def _run_git(self, function, args, **kwargs):
+        """Runs git in the buck directory using the given subprocess function.
+
+        On Python 3.8+ subprocess starts the child with posix_spawn instead
+        of fork and exec only if close_fds is off, no cwd is given and the
+        executable path has a directory part, so git is run by its absolute
+        path with -C. Python 2 always forks.
+        """
+        return function(
+            [self._git_path, '-C', self._buck_dir] + args,
+            close_fds=False,
+            **kwargs)
+
+    def _prefetch_git_state(self):
+        """Runs the independent git queries every launch needs in parallel.
+
+        Results land in the same caches the getters use. A query that fails
+        here is left uncached, so its getter runs it again and reports the
+        error from the main thread.
+        """
+        def run_quietly(function):
+            try:
+                function()
+            except Exception:
+                pass
+
+        functions = [self._get_git_revision]
+        # git status is only read when the checkout may be dirty, which an
+        # override other than "1" rules out.
+        override = self._is_buck_repo_dirty_override
+        if not override or override == "1":
+            functions.append(self._get_git_status)
+
+        threads = [
+            threading.Thread(target=run_quietly, args=(function,))
+            for function in functions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
     def _is_dirty(self):
         if self._is_buck_repo_dirty_override:
@@ -372,45 +486,77 @@ class BuckRepo:
         if not self._is_git:
             return False
 
-        output = check_output(
-            ['git', 'status', '--porcelain'],
-            cwd=self._buck_dir)
-        return bool(output.strip())
+        return bool(self._get_git_status().strip('\0'))
+
+    def _get_git_status(self):
+        if self._cached_status is None:
+            self._cached_status = self._run_git(
+                check_output,
+                ['status', '--porcelain', '-z'])
+        return self._cached_status
+
+    def _get_local_hash(self):
+        key = get_local_changes_key(
+            self._buck_dir,
+            self._get_git_revision(),
+            self._get_git_status(),
+            time.time())
+        if key is None:
+            return self._compute_local_hash()
+
+        cache = self._buck_project.get_buck_version_uid_cache()
+        if cache and cache.get('key') == key:
+            return str(cache['uid'])
+
+        local_hash = self._compute_local_hash()
+        self._buck_project.save_buck_version_uid_cache(
+            {'key': key, 'uid': local_hash})
+        return local_hash
 
     def _has_local_changes(self):
         if not self._is_git:
             return False
 
-        output = check_output(
-            ['git', 'ls-files', '-m'],
-            cwd=self._buck_dir)
+        output = self._run_git(check_output, ['ls-files', '-m'])
         return bool(output.strip())
 
     def _get_git_revision(self):
         if not self._is_git:
             return 'N/A'
 
-        output = check_output(
-            ['git', 'rev-parse', 'HEAD', '--'],
-            cwd=self._buck_dir)
-        return output.splitlines()[0].strip()
+        if self._cached_revision is None:
+            output = self._run_git(check_output, ['rev-parse', 'HEAD', '--'])
+            self._cached_revision = output.splitlines()[0].strip()
+        return self._cached_revision
 
     def _get_git_commit_timestamp(self):
         if self._is_buck_repo_dirty_override or not self._is_git:
             return -1
 
-        return check_output(
-            ['git', 'log', '--pretty=format:%ct', '-1', 'HEAD', '--'],
-            cwd=self._buck_dir).strip()
+        if self._cached_timestamp is None:
+            self._cached_timestamp = self._run_git(
+                check_output,
+                ['log', '--pretty=format:%ct', '-1', 'HEAD', '--']).strip()
+        return self._cached_timestamp
 
     def _revision_exists(self, revision):
-        returncode = subprocess.call(
-            ['git', 'cat-file', '-e', revision],
-            cwd=self._buck_dir)
+        returncode = self._run_git(
+            subprocess.call,
+            ['cat-file', '-e', revision])
         return returncode == 0
 
+    def _has_ant(self):
+        if self._cached_has_ant is None:
+            self._cached_has_ant = bool(which('ant'))
+        return self._cached_has_ant
+
+    def _has_watchman(self):
+        if self._cached_has_watchman is None:
+            self._cached_has_watchman = bool(which('watchman'))
+        return self._cached_has_watchman
+
     def _check_for_ant(self):
-        if not which('ant'):
+        if not self._has_ant():
             message = "You do not have ant on your $PATH. Cannot build Buck."
             if sys.platform == "darwin":
                 message += "\nTry running 'brew install ant'."
@@ -454,41 +600,47 @@ class BuckRepo:
             sys.exit(exitcode)
 
     def _compute_local_hash(self):
-        git_tree_in = check_output(
-            ['git', 'log', '-n1', '--pretty=format:%T', 'HEAD', '--'],
-            cwd=self._buck_dir).strip()
+        # The scratch index can be several megabytes; keep it off the disk
+        # when a tmpfs is available.
+        index_dir = self._tmp_dir
+        if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+            index_dir = SHM_DIR
 
         with tempfile.NamedTemporaryFile(prefix='buck-git-index',
-                                         dir=self._tmp_dir) as index_file:
+                                         dir=index_dir) as index_file:
             new_environ = os.environ.copy()
             new_environ['GIT_INDEX_FILE'] = index_file.name
-            subprocess.check_call(
-                ['git', 'read-tree', git_tree_in],
-                cwd=self._buck_dir,
+            # read-tree takes any tree-ish, so there is no need to ask for
+            # the tree of HEAD first.
+            self._run_git(
+                subprocess.check_call,
+                ['read-tree', 'HEAD'],
                 env=new_environ)
 
-            subprocess.check_call(
-                ['git', 'add', '-u'],
-                cwd=self._buck_dir,
-                stderr=DEV_NULL,
-                env=new_environ)
+            with open(os.devnull, 'w') as dev_null:
+                self._run_git(
+                    subprocess.check_call,
+                    ['add', '-u'],
+                    stderr=dev_null,
+                    env=new_environ)
 
-            git_tree_out = check_output(
-                ['git', 'write-tree'],
-                cwd=self._buck_dir,
+            git_tree_out = self._run_git(
+                check_output,
+                ['write-tree'],
                 env=new_environ).strip()
 
-        with tempfile.NamedTemporaryFile(prefix='buck-version-uid-input',
-                                         dir=self._tmp_dir) as uid_input:
-            subprocess.check_call(
-                ['git', 'ls-tree',  '--full-tree', git_tree_out],
-                cwd=self._buck_dir,
-                stdout=uid_input)
-            return check_output(
-                ['git', 'hash-object', uid_input.name],
-                cwd=self._buck_dir).strip()
+        ls_tree = self._run_git(
+            check_output,
+            ['ls-tree', '--full-tree', git_tree_out])
+        # Hash the listing the way 'git hash-object' would, without another
+        # git process.
+        return hashlib.sha1(
+            'blob {0}\0'.format(len(ls_tree)) + ls_tree).hexdigest()
 
     def _build(self):
+        if self._built:
+            return
+
         if not os.path.exists(self._build_success_file):
             # TODO(natthu): kill buckd if running, and
             # restart buckd only if it was running before.
@@ -498,6 +650,7 @@ class BuckRepo:
             self._check_for_ant()
             self._run_ant_clean()
             self._run_ant()
+        self._built = True
 
     def _get_buck_version_uid(self):
         if not self._is_git:
@@ -508,7 +661,7 @@ class BuckRepo:
 
         if (self._buck_project.has_no_buck_check or
                 not self._buck_project.buck_version):
-            return self._compute_local_hash()
+            return self._get_local_hash()
 
         if self._has_local_changes():
             print(textwrap.dedent("""\
@@ -516,10 +669,10 @@ class BuckRepo:
             ::: builds will not be able to use a distributed cache.
             ::: The following files must be either reverted or committed:"""),
                   file=sys.stderr)
-            subprocess.call(
-                ['git', 'ls-files', '-m'],
-                stdout=sys.stderr,
-                cwd=self._buck_dir)
+            self._run_git(
+                subprocess.call,
+                ['ls-files', '-m'],
+                stdout=sys.stderr)
         elif os.environ.get('BUCK_CLEAN_REPO_IF_DIRTY') != 'NO':
             print(textwrap.dedent("""\
             ::: Your local buck directory is dirty, and therefore builds will
@@ -530,13 +683,13 @@ class BuckRepo:
                     file=sys.stderr)
                 choice = raw_input().lower()
                 if choice == "y":
-                    subprocess.call(
-                        ['git', 'clean', '-fd'],
-                        stdout=sys.stderr,
-                        cwd=self._buck_dir)
+                    self._run_git(
+                        subprocess.call,
+                        ['clean', '-fd'],
+                        stdout=sys.stderr)
                     self._restart_buck()
 
-        return self._compute_local_hash()
+        return self._get_local_hash()
 
     def _get_java_args(self, version_uid):
         java_args = [] if is_java8() else ["-XX:MaxPermSize=256m"]
@@ -551,13 +704,8 @@ class BuckRepo:
             "-Dbuck.version_uid={0}".format(version_uid),
             "-Dbuck.git_dirty={0}".format(int(self._is_dirty())),
             "-Dbuck.buckd_dir={0}".format(self._buck_project.buckd_dir),
-            "-Dbuck.buck_dir={0}".format(self._buck_dir),
-            "-Dlog4j.configuration=file:{0}".format(
-                self._join_buck_dir("config/log4j.properties")),
         ])
-        for key, value in BUCK_DIR_JAVA_ARGS.items():
-            java_args.append("-Dbuck.{0}={1}".format(
-                             key, self._join_buck_dir(value)))
+        java_args.extend(self._static_buck_dir_args)
 
         if os.environ.get("BUCK_DEBUG_MODE"):
             java_args.append("-agentlib:jdwp=transport=dt_socket,"
@@ -566,25 +714,27 @@ class BuckRepo:
         if os.environ.get("BUCK_DEBUG_SOY"):
             java_args.append("-Dbuck.soy.debug=true")
 
-        if self._buck_project.buck_javaargs:
-            java_args.extend(self._buck_project.buck_javaargs.split(' '))
-
-        extra_java_args = os.environ.get("BUCK_EXTRA_JAVA_ARGS")
-        if extra_java_args:
-            java_args.extend(extra_java_args.split(' '))
+        java_args.extend(get_extra_java_args(
+            self._buck_project.buck_javaargs, os.environ))
         return java_args
 
-    def _get_java_classpath(self):
-        return ':'.join([self._join_buck_dir(p) for p in JAVA_CLASSPATHS])
-
 
 class BuckRepoException(Exception):
     pass
 
 
-#
-# an almost exact copy of the shutil.which() implementation from python3.4
-#
+def _stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+# Results of which() lookups. Buck's wrapper is short-lived, so a command is
+# looked up at most once per search path and the result is never refreshed.
+_WHICH_RESULTS = {}
+
+
 def which(cmd, mode=os.F_OK | os.X_OK, path=None):
     """Given a command, mode, and a PATH string, return the path which
     conforms to the given mode on the PATH, or None if there is no such
@@ -595,12 +745,26 @@ def which(cmd, mode=os.F_OK | os.X_OK, path=None):
     path.
 
     """
+    if path is None:
+        path = os.environ.get("PATH", os.defpath)
+    key = (cmd, mode, path)
+    if key not in _WHICH_RESULTS:
+        _WHICH_RESULTS[key] = _which(cmd, mode, path)
+    return _WHICH_RESULTS[key]
+
+
+#
+# an almost exact copy of the shutil.which() implementation from python3.4
+#
+def _which(cmd, mode, path):
     # Check that a given file can be accessed with the correct mode.
     # Additionally check that `file` is not a directory, as on Windows
-    # directories pass the os.access check.
+    # directories pass the os.access check. A single stat covers existence
+    # and the directory test.
     def _access_check(fn, mode):
-        return (os.path.exists(fn) and os.access(fn, mode)
-                and not os.path.isdir(fn))
+        st = _stat_or_none(fn)
+        return (st is not None and not stat.S_ISDIR(st.st_mode)
+                and os.access(fn, mode))
 
     # If we're given a path with a directory part, look it up directly rather
     # than referring to PATH directories. This includes checking relative to
@@ -610,8 +774,6 @@ def which(cmd, mode=os.F_OK | os.X_OK, path=None):
             return cmd
         return None
 
-    if path is None:
-        path = os.environ.get("PATH", os.defpath)
     if not path:
         return None
     path = path.split(os.pathsep)
@@ -667,7 +829,152 @@ def check_output(*popenargs, **kwargs):
     return output
 
 
+def get_extra_java_args(buck_javaargs, environ):
+    """Returns the JVM arguments given in .buckjavaargs and in the
+    BUCK_EXTRA_JAVA_ARGS variable of `environ`, split the way a shell would.
+    """
+    java_args = []
+    if buck_javaargs:
+        java_args.extend(shlex.split(buck_javaargs))
+
+    extra_java_args = environ.get("BUCK_EXTRA_JAVA_ARGS")
+    if extra_java_args:
+        java_args.extend(shlex.split(extra_java_args))
+    return java_args
+
+
+def get_changed_paths(status):
+    """Returns the paths listed in `git status --porcelain -z` output.
+
+    Renames and copies are listed under their new path only.
+    """
+    paths = []
+    entries = iter(status.split('\0'))
+    for entry in entries:
+        if not entry:
+            continue
+        # Renames and copies are followed by the path they came from.
+        if entry[0] in 'RC':
+            next(entries, None)
+        paths.append(entry[3:])
+    return paths
+
+
+def get_local_changes_key(buck_dir, revision, status, now):
+    """Returns a digest of the local changes BuckRepo._compute_local_hash
+    reads, given the revision and `git status --porcelain -z` output.
+
+    Like git's own index, this relies on the stat data of each changed file
+    to notice further edits. Returns None when a file changed too recently,
+    relative to `now`, for its timestamps to be trusted.
+    """
+    key = hashlib.sha1()
+    key.update(buck_dir + '\0' + revision + '\0')
+    key.update(status)
+    for path in get_changed_paths(status):
+        try:
+            st = os.stat(os.path.join(buck_dir, path))
+        except OSError:
+            key.update('\0-')
+            continue
+        if now - max(st.st_mtime, st.st_ctime) < 1:
+            return None
+        key.update('\0{0!r}\0{1!r}\0{2}\0{3}\0{4}'.format(
+            st.st_mtime, st.st_ctime, st.st_size, st.st_mode, st.st_ino))
+    return key.hexdigest()
+
+
+def read_buckd_port(fd, timeout_secs):
+    """Waits for the nailgun server to log the port it is listening on.
+
+    `fd` is the read end of buckd's output. Returns the port, or None if the
+    output ends or stays silent for `timeout_secs`.
+    """
+    deadline = time.time() + timeout_secs
+    pending = ''
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        readable, _, _ = select.select([fd], [], [], remaining)
+        if not readable:
+            return None
+        try:
+            chunk = os.read(fd, BUCKD_OUTPUT_READ_SIZE)
+        except OSError as e:
+            # Reading a pty master whose slave has been closed fails
+            # with EIO rather than returning EOF.
+            if e.errno != errno.EIO:
+                raise
+            chunk = ''
+        if not chunk:
+            return None
+
+        pending += chunk
+        # Only complete lines are matched, so keep reading until the
+        # chunk finishes one.
+        if '\n' not in chunk:
+            continue
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            # Most lines are unrelated log output; skip the regex for them.
+            if ' port ' not in line:
+                continue
+            match = BUCKD_LOG_FILE_PATTERN.match(line.strip())
+            if match:
+                return match.group(1)
+
+
+def is_port_listening(port):
+    """Checks the kernel's TCP tables for a socket listening on `port`.
+
+    Reading /proc/net/tcp avoids making a connection to find out. Returns
+    None when the tables are not available (i.e. on anything but Linux).
+    """
+    found_table = False
+    for table in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            with open(table) as f:
+                lines = f.readlines()
+        except IOError:
+            continue
+        found_table = True
+        # Skip the header. Each entry starts with
+        # "sl local_address rem_address st", where local_address is
+        # "<hex address>:<hex port>".
+        for line in lines[1:]:
+            fields = line.split()
+            if (len(fields) > 3 and fields[3] == TCP_LISTEN_STATE and
+                    int(fields[1].rsplit(':', 1)[1], 16) == port):
+                return True
+    return False if found_table else None
+
+
+_is_java8 = None
+_is_java8_lock = threading.Lock()
+
+
 def is_java8():
+    global _is_java8
+    with _is_java8_lock:
+        if _is_java8 is None:
+            _is_java8 = _detect_java8()
+        return _is_java8
+
+
+def _detect_java8():
+    # Reading the 'release' file of the JDK/JRE that 'java' resolves to is
+    # much cheaper than starting a whole JVM just to ask for its version.
+    java = which('java')
+    if java:
+        java_home = os.path.dirname(os.path.dirname(os.path.realpath(java)))
+        # A JDK's java may live in <jdk>/jre/bin, with the file in <jdk>.
+        for home in [java_home, os.path.dirname(java_home)]:
+            release_file = os.path.join(home, 'release')
+            if os.path.isfile(release_file):
+                with open(release_file) as f:
+                    return bool(JAVA_RELEASE_VERSION_PATTERN.search(f.read()))
+
     output = check_output(['java', '-version'], stderr=subprocess.STDOUT)
-    version_line = output.strip().splitlines()[0]
-    return re.compile('java version "1\.8\..*').match(version_line)
+    return output.strip().splitlines()[0].startswith('java version "1.8.')
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-present Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# Unit tests for buck_repo.py
+
+from buck_repo import get_changed_paths, get_extra_java_args, \
+    get_local_changes_key, read_buckd_port, which
+
+import os
+import pty
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+class TestBuckRepo(unittest.TestCase):
+
+    def test_extra_java_args_absent(self):
+        self.assertEqual([], get_extra_java_args(None, {}))
+        self.assertEqual(
+            [], get_extra_java_args('', {'BUCK_EXTRA_JAVA_ARGS': ''}))
+
+    def test_buck_javaargs_keeps_quoted_values_together(self):
+        self.assertEqual(
+            ['-Xmx2g', '-Dfoo=a b', '-Dbar=c d'],
+            get_extra_java_args('-Xmx2g -Dfoo="a b" \'-Dbar=c d\'', {}))
+
+    def test_env_java_args_keeps_quoted_values_together(self):
+        self.assertEqual(
+            ['-Dfoo=a b', '-Dbaz=1'],
+            get_extra_java_args(
+                None, {'BUCK_EXTRA_JAVA_ARGS': '-Dfoo="a b" -Dbaz=1'}))
+
+    def test_doubled_spaces_do_not_produce_empty_args(self):
+        self.assertEqual(
+            ['-Xmx2g', '-Dfoo=bar', '-Dbaz=1'],
+            get_extra_java_args(
+                '  -Xmx2g  -Dfoo=bar ',
+                {'BUCK_EXTRA_JAVA_ARGS': '-Dbaz=1   '}))
+
+    def test_backslashes_follow_shell_quoting(self):
+        # Unquoted backslashes escape the next character, as in a shell;
+        # single quotes keep them literally.
+        self.assertEqual(
+            ['-Dfoo=a b', '-Ddir=C:dir', '-Ddir=C:\\dir'],
+            get_extra_java_args(
+                '-Dfoo=a\\ b -Ddir=C:\\dir',
+                {'BUCK_EXTRA_JAVA_ARGS': "'-Ddir=C:\\dir'"}))
+
+    def test_buck_javaargs_come_before_env_java_args(self):
+        self.assertEqual(
+            ['-Dfrom=file', '-Dfrom=env'],
+            get_extra_java_args(
+                '-Dfrom=file', {'BUCK_EXTRA_JAVA_ARGS': '-Dfrom=env'}))
+
+    def test_which_skips_directories_and_inaccessible_files(self):
+        root = tempfile.mkdtemp()
+        try:
+            dirs = [os.path.join(root, name) for name in 'abc']
+            for dir in dirs:
+                os.mkdir(dir)
+            os.mkdir(os.path.join(dirs[0], 'tool'))
+            for dir, mode in [(dirs[1], 0o644), (dirs[2], 0o755)]:
+                open(os.path.join(dir, 'tool'), 'w').close()
+                os.chmod(os.path.join(dir, 'tool'), mode)
+            path = os.pathsep.join(dirs)
+            self.assertEqual(
+                os.path.join(dirs[2], 'tool'), which('tool', path=path))
+            self.assertEqual(
+                os.path.join(dirs[1], 'tool'),
+                which('tool', mode=os.R_OK, path=path))
+            self.assertEqual(None, which('missing', path=path))
+        finally:
+            shutil.rmtree(root)
+
+    def test_changed_paths_of_modified_and_deleted_files(self):
+        self.assertEqual([], get_changed_paths(''))
+        self.assertEqual(
+            ['a.py', 'dir/b.py', 'c.py'],
+            get_changed_paths(' M a.py\0 D dir/b.py\0MM c.py\0'))
+
+    def test_changed_paths_of_renames_and_copies(self):
+        # -z lists the new path first, followed by the original path as a
+        # separate entry, which may itself look like a status line.
+        self.assertEqual(
+            ['new.py', 'copy.py', 'd.py'],
+            get_changed_paths(
+                'R  new.py\0 M old.py\0C  copy.py\0orig.py\0 M d.py\0'))
+
+    def test_changed_paths_with_spaces_and_arrows(self):
+        self.assertEqual(
+            ['a b.py', 'x -> y.py'],
+            get_changed_paths(' M a b.py\0?? x -> y.py\0'))
+
+
+class TestLocalChangesKey(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'a.py')
+        with open(self.path, 'w') as f:
+            f.write('a')
+        self.now = time.time() + 10
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get_key(self, status):
+        return get_local_changes_key(self.dir, 'rev', status, self.now)
+
+    def test_key_changes_with_mode(self):
+        before = self.get_key(' M a.py\0')
+        os.chmod(self.path, stat.S_IRWXU)
+        self.assertNotEqual(before, self.get_key(' M a.py\0'))
+
+    def test_key_changes_when_file_is_replaced(self):
+        before = self.get_key(' M a.py\0')
+        replacement = os.path.join(self.dir, 'b.py')
+        with open(replacement, 'w') as f:
+            f.write('b')
+        st = os.stat(self.path)
+        os.utime(replacement, (st.st_atime, st.st_mtime))
+        os.rename(replacement, self.path)
+        self.assertNotEqual(before, self.get_key(' M a.py\0'))
+
+    def test_key_of_deleted_file(self):
+        before = self.get_key(' D gone.py\0')
+        self.assertNotEqual(None, before)
+        self.assertEqual(before, self.get_key(' D gone.py\0'))
+        self.assertNotEqual(before, self.get_key(' D a.py\0'))
+
+    def test_key_follows_renamed_path(self):
+        before = self.get_key('R  a.py\0old.py\0')
+        self.assertNotEqual(None, before)
+        os.chmod(self.path, stat.S_IRWXU)
+        self.assertNotEqual(before, self.get_key('R  a.py\0old.py\0'))
+
+    def test_no_key_for_recently_changed_file(self):
+        self.now = time.time()
+        self.assertEqual(None, self.get_key(' M a.py\0'))
+
+
+class TestReadBuckdPort(unittest.TestCase):
+
+    def start_writer(self, script, use_pty=True):
+        """Runs `script` with its stdout connected to the returned fd."""
+        if use_pty:
+            read_fd, write_fd = pty.openpty()
+        else:
+            read_fd, write_fd = os.pipe()
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'import sys, time\n' + script],
+            stdout=write_fd)
+        os.close(write_fd)
+
+        def clean_up():
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            os.close(read_fd)
+        self.addCleanup(clean_up)
+        return read_fd
+
+    def test_port_line_split_across_writes(self):
+        # The pty is not in raw mode, so the line also ends in \r\n.
+        fd = self.start_writer(
+            "sys.stdout.write('NGServer started on 127.0.0.1, port ')\n"
+            "sys.stdout.flush()\n"
+            "time.sleep(0.2)\n"
+            "sys.stdout.write('4567.\\n')\n"
+            "sys.stdout.flush()\n"
+            "time.sleep(10)\n")
+        self.assertEqual('4567', read_buckd_port(fd, 5))
+
+    def test_noise_before_port_line(self):
+        fd = self.start_writer(
+            "sys.stdout.write('Picked up JAVA_TOOL_OPTIONS\\n')\n"
+            "sys.stdout.write('the port is not ready\\n')\n"
+            "sys.stdout.write('NGServer started on 0.0.0.0, port 1234.\\n')\n"
+            "sys.stdout.flush()\n"
+            "time.sleep(10)\n")
+        self.assertEqual('1234', read_buckd_port(fd, 5))
+
+    def test_child_exits_without_port(self):
+        for use_pty in [True, False]:
+            fd = self.start_writer("print('Error: no main class')\n", use_pty)
+            start = time.time()
+            self.assertEqual(None, read_buckd_port(fd, 10))
+            self.assertTrue(time.time() - start < 5)
+
+    def test_silent_child_times_out(self):
+        fd = self.start_writer("time.sleep(10)\n")
+        start = time.time()
+        self.assertEqual(None, read_buckd_port(fd, 0.3))
+        self.assertTrue(time.time() - start >= 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -512,6 +512,8 @@ public final class Main {
     if (!commandParseResult.getCommand().get().isReadOnly()) {
       commandSemaphoreAcquired = commandSemaphore.tryAcquire();
       if (!commandSemaphoreAcquired) {
+        console.getStdErr().println(
+            "Daemon is busy, please wait or run \"buckd --kill\" to terminate it.");
         return BUSY_EXIT_CODE;
       }
     }
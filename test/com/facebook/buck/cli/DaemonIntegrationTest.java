@@ -110,12 +110,16 @@ public class DaemonIntegrationTest {
         createRunnableCommand(SUCCESS_EXIT_CODE, "build", "//:sleep"),
         0,
         TimeUnit.MILLISECONDS);
+    final CapturingPrintStream secondStderr = new CapturingPrintStream();
     Future<?> secondThread = executorService.schedule(
-        createRunnableCommand(Main.BUSY_EXIT_CODE, "build", "//:sleep"),
+        createRunnableCommand(Main.BUSY_EXIT_CODE, secondStderr, "build", "//:sleep"),
         500L,
         TimeUnit.MILLISECONDS);
     firstThread.get();
     secondThread.get();
+    assertThat(
+        secondStderr.getContentsAsString(Charsets.UTF_8),
+        containsString("Daemon is busy, please wait or run \"buckd --kill\" to terminate it."));
   }
 
   /**
@@ -214,11 +218,18 @@ public class DaemonIntegrationTest {
   }
 
   private Runnable createRunnableCommand(final int expectedExitCode, final String ... args) {
+    return createRunnableCommand(expectedExitCode, new CapturingPrintStream(), args);
+  }
+
+  private Runnable createRunnableCommand(
+      final int expectedExitCode,
+      final CapturingPrintStream stderr,
+      final String ... args) {
     return new Runnable() {
       @Override
       public void run() {
         try {
-          Main main = new Main(new CapturingPrintStream(), new CapturingPrintStream());
+          Main main = new Main(new CapturingPrintStream(), stderr);
           int exitCode = main.tryRunMainWithExitCode(
               new BuildId(),
               tmp.getRoot(),